@@ -6,8 +6,9 @@ This source code is licensed under the license found in the
 LICENSE file in the root directory of this source tree.
 """
 
-from .entities import Grammateus
+from .entities import Grammateus, InvalidJSONRecord
 
 __all__ = [
-    'Grammateus'
+    'Grammateus',
+    'InvalidJSONRecord'
 ]
\ No newline at end of file
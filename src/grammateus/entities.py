@@ -6,17 +6,250 @@ This source code is licensed under the license found in the
 LICENSE file in the root directory of this source tree.
 """
 from os import path, getenv
-from json import loads, dumps
-import jsonlines
+import os
+import mmap
+import re
+from json import loads as json_loads
+from functools import cached_property, partial
+import orjson
 
 
 default_base = getenv('GRAMMATEUS_LOCATION', './')
 
+# non-string keys are written as strings, like the stdlib json did
+_dumps = partial(orjson.dumps, option=orjson.OPT_NON_STR_KEYS)
+_loads = orjson.loads
+# orjson reads integers wider than 64 bits back as floats
+_LONG_INT = re.compile(rb'\d{20,}')
+
+
+class InvalidJSONRecord(ValueError):
+    pass
+
+
+def _load_line(line: bytes):
+    if _LONG_INT.search(line) is not None:
+        return json_loads(line)
+    try:
+        return _loads(line)
+    except orjson.JSONDecodeError:
+        # NaN and Infinity in files written with the stdlib json
+        return json_loads(line)
+
+
+def _read_jsonl(location: str) -> list:
+    lines = []
+    with open(location, 'rb') as reader:
+        if not os.fstat(reader.fileno()).st_size:
+            return lines
+        with mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):  # not on Windows
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            start = 0
+            end = data.find(b'\n')
+            while end >= 0:
+                if end > start:
+                    lines.append(_load_line(data[start:end]))
+                start = end + 1
+                end = data.find(b'\n', start)
+            if start < len(data):
+                lines.append(_load_line(data[start:]))
+    return lines
+
+
+def _json_line(text: str) -> tuple:
+    # the string is written as given and parsed the way it will be read back,
+    # so the cached object always matches the file
+    line = text.encode()
+    try:
+        obj = _load_line(line)
+    except ValueError as error:
+        raise InvalidJSONRecord('Can not convert string to JSON') from error
+    if b'\n' in line:
+        # a raw newline in valid JSON is always whitespace
+        line = line.replace(b'\n', b' ')
+    return line + b'\n', obj
+
+
+def _handler(handlers: dict, obj):
+    handler = handlers.get(type(obj))
+    if handler is None:
+        # subclasses such as OrderedDict miss the exact type lookup
+        handler = next((handlers[base] for base in type(obj).__mro__
+                        if base in handlers), None)
+    return handler
+
+
+def _dict_line(obj: dict) -> tuple:
+    line = _dumps(obj)
+    if b'null' in line:
+        # NaN and Infinity are written as null, cache what the file holds
+        obj = _loads(line)
+    return line + b'\n', obj
+
+
+# how every accepted input type becomes a (line, parsed object) pair
+_LINES = {dict: _dict_line, str: _json_line}
+
+
+def _to_line(obj, kind: str) -> tuple:
+    converter = _handler(_LINES, obj)
+    if converter is None:
+        raise TypeError(f'Wrong {kind} type: {type(obj).__name__}')
+    return converter(obj)
+
+
+def _to_lines(objs: list, kind: str) -> tuple:
+    # the whole batch is converted before anything is written
+    pairs = [_to_line(obj, kind) for obj in objs]
+    return b''.join(line for line, _ in pairs), [obj for _, obj in pairs]
+
+
+def _write(fd: int, data: bytes):
+    written = os.write(fd, data)
+    if written < len(data):
+        # regular files take the whole buffer unless a signal cuts it short
+        view = memoryview(data)
+        while written < len(data):
+            written += os.write(fd, view[written:])
+
+
+def _fingerprint(location: str) -> tuple:
+    status = os.stat(location)
+    return status.st_size, status.st_mtime_ns
+
+
+def _separator(location: str) -> bytes:
+    # a file whose last line has no newline needs one before the next append
+    if not path.exists(location):
+        return b''
+    with open(location, 'rb') as reader:
+        if not reader.seek(0, os.SEEK_END):
+            return b''
+        reader.seek(-1, os.SEEK_END)
+        return b'' if reader.read(1) == b'\n' else b'\n'
+
+
+def _is_current(fingerprint: tuple, known: tuple, written: int) -> bool:
+    if known is None:
+        return False
+    if written:
+        # our own appends move the mtime, so only the size can be checked
+        return fingerprint[0] == known[0] + written
+    return fingerprint == known
+
+
+class _RecordBackend():
+    def __init__(self, location: str):
+        self.location = location
+        self.records = []
+        self._written = 0
+        os.makedirs(path.dirname(location), exist_ok=True)
+        if path.exists(location):
+            self.records = _read_jsonl(location)
+        self._separator = _separator(location)
+        self._file = open(location, 'ab', buffering=1 << 20)
+        self._stat = _fingerprint(location)
+
+    def _write_lines(self, lines: bytes):
+        if self._separator:
+            lines = self._separator + lines
+            self._separator = b''
+        self._file.write(lines)
+        self._written += len(lines)
+
+    def append(self, line: bytes, record):
+        self._write_lines(line)
+        self.records.append(record)
+
+    def extend(self, lines: bytes, records_list: list):
+        self._write_lines(lines)
+        self.records.extend(records_list)
+
+    def read(self) -> list:
+        self._file.flush()
+        fingerprint = _fingerprint(self.location)
+        if not _is_current(fingerprint, self._stat, self._written):
+            self.records = _read_jsonl(self.location)
+        self._stat = fingerprint
+        self._written = 0
+        return list(self.records)
+
+    def flush(self):
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self, sync: bool = True):
+        try:
+            if sync:
+                self.flush()
+        finally:
+            self._file.close()
+
+
+class _LogBackend():
+    def __init__(self, location: str):
+        self.location = location
+        self.log = None  # parsed on the first read()
+        self._stat = None
+        self._written = 0
+        os.makedirs(path.dirname(location), exist_ok=True)
+        self._separator = _separator(location)
+        self._fd = os.open(location,
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT
+                           | getattr(os, 'O_BINARY', 0), 0o644)
+
+    def _write_lines(self, lines: bytes) -> int:
+        if self._separator:
+            lines = self._separator + lines
+            self._separator = b''
+        _write(self._fd, lines)
+        return len(lines)
+
+    def append(self, line: bytes, event):
+        written = self._write_lines(line)
+        if self.log is not None:
+            self._written += written
+            self.log.append(event)
+
+    def extend(self, lines: bytes, events: list):
+        written = self._write_lines(lines)
+        if self.log is not None:
+            self._written += written
+            self.log.extend(events)
+
+    def append_raw(self, lines: bytes):
+        # lines bypass the cache, the next read() takes them from the file
+        self._write_lines(lines)
+
+    def read(self) -> list:
+        fingerprint = _fingerprint(self.location)
+        if not _is_current(fingerprint, self._stat, self._written):
+            self.log = _read_jsonl(self.location)
+        self._stat = fingerprint
+        self._written = 0
+        return list(self.log)
+
+    def flush(self):
+        if self._fd is not None:
+            os.fsync(self._fd)
+
+    # os.close is bound at definition time, __del__ can run at interpreter
+    # shutdown when the module globals are already gone
+    def close(self, sync: bool = True, _close=os.close):
+        if self._fd is not None:
+            fd, self._fd = self._fd, None
+            try:
+                if sync:
+                    os.fsync(fd)
+            finally:
+                _close(fd)
+
 
 class Grammateus():
     location = str
     log_location = str
-    records = []
 
     def __init__(self,
                  origin: str, # anthropic, openai, gemini or palm
@@ -24,49 +257,96 @@ class Grammateus():
                  **kwargs):
         self.location = f'{default_base}{origin}/{location}'
         self.log_location = f'{default_base}AILogs/{origin}/{location}'
-        if path.exists(self.location):
-            self._read_records()
         super(Grammateus, self).__init__(**kwargs)
 
-    def _read_records(self):
-        with jsonlines.open(file=self.location, mode='r') as reader:
-            self.records = list(reader)
+    def __enter__(self):
+        return self
 
-    def _record_one(self, record: dict):
-        self.records.append(record)
-        with jsonlines.open(file=self.location, mode='a') as writer:
-            writer.write(record)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # only release the files, collection should not wait for the disk
+        self._close(sync=False)
+
+    # the files are opened on first use, so an instance that only logs
+    # never touches the records file and the other way round
+    @cached_property
+    def _records(self) -> _RecordBackend:
+        return _RecordBackend(self.location)
+
+    @cached_property
+    def _log(self) -> _LogBackend:
+        return _LogBackend(self.log_location)
+
+    def _backends(self) -> list:
+        return [backend for backend in (self.__dict__.get('_records'),
+                                        self.__dict__.get('_log'))
+                if backend is not None]
 
-    def _record_one_json(self, record: str):
-        record_dict = loads(record)
-        self.records.append(record_dict)
-        with jsonlines.open(file=self.location, mode='a') as writer:
-            writer.write(record_dict)
+    def _existing_records(self):
+        # reading must not create the records file of a log-only instance
+        if '_records' in self.__dict__ or path.exists(self.location):
+            return self._records
+        return None
 
-    def _record_many(self, records_list):
-        with jsonlines.open(file=self.location, mode='a') as writer:
-            writer.write_all(records_list)
+    def _existing_log(self):
+        # reading must not create the log file of a record-only instance
+        if '_log' in self.__dict__ or path.exists(self.log_location):
+            return self._log
+        return None
+
+    @property
+    def records(self) -> list:
+        backend = self._existing_records()
+        return [] if backend is None else list(backend.records)
 
     def record(self, record):
-        if isinstance(record, dict):
-            self._record_one(record)
-        elif isinstance(record, str):
-            self._record_one_json(record)
-        else:
-            print("Wrong record type")
+        self._records.append(*_to_line(record, 'record'))
+
+    def record_many(self, records_list: list):
+        lines, parsed = _to_lines(records_list, 'record')
+        if parsed:
+            self._records.extend(lines, parsed)
+
+    def log_event(self, event):
+        self._log.append(*_to_line(event, 'event'))
+
+    def log_many(self, events: list):
+        lines, parsed = _to_lines(events, 'event')
+        if parsed:
+            self._log.extend(lines, parsed)
 
-    def log_event(self, event: dict):
-        with jsonlines.open(file=self.log_location, mode='a') as writer:
-            writer.write(event)
+    def _append_raw(self, lines: bytes):
+        self._log.append_raw(lines)
 
     def get_records(self):
-        return self.records
+        backend = self._existing_records()
+        return [] if backend is None else backend.read()
 
     def get_log(self):
-        with jsonlines.open(file=self.log_location, mode='r') as reader:
-            log = list(reader)
-        return log
+        backend = self._existing_log()
+        return [] if backend is None else backend.read()
+
+    def flush(self):
+        for backend in self._backends():
+            backend.flush()
+
+    def _close(self, sync: bool):
+        # forget the closed backends, the next call opens the files again
+        records = self.__dict__.pop('_records', None)
+        log = self.__dict__.pop('_log', None)
+        try:
+            if records is not None:
+                records.close(sync)
+        finally:
+            # a failed sync of the records must not leak the log descriptor
+            if log is not None:
+                log.close(sync)
+
+    def close(self):
+        self._close(sync=True)
 
 
 if __name__ == '__main__':
-    print('ok')
\ No newline at end of file
+    print('ok')
@@ -5,26 +5,320 @@
 This source code is licensed under the license found in the
 LICENSE file in the root directory of this source tree.
 """
-import dotenv
-dotenv.load_dotenv()
+import os
+from os import path
 from json import dumps
-import jsonlines
+import shutil
+import tempfile
+from uuid import uuid4
+from unittest import mock
+from collections import OrderedDict
+import orjson
 import pytest
-from ..grammateus.entities import Grammateus
+from ..grammateus import entities
+from ..grammateus.entities import Grammateus, InvalidJSONRecord
+
+
+# keep the test files in memory where a tmpfs is available
+TEMP_ROOT = '/dev/shm' if path.isdir('/dev/shm') else None
+
+# files as they are found on disk, written without going through Grammateus
+FIXTURES = {
+    'records_2': b'{"record1":"value1"}\n{"record2":"value2"}\n',
+    'records_gaps': b'{"record1":"value1"}\n\n{"record2":"value2"}',
+    'log_2': b'{"event":"request"}\n{"event":"response"}\n',
+    'records_nan': b'{"score":NaN}\n{"score":1.5}\n',
+    'records_long_int': b'{"id":1180591620717411303424}\n',
+}
+
+
+def write_fixture(location: str, name: str):
+    os.makedirs(path.dirname(location), exist_ok=True)
+    with open(location, 'wb') as writer:
+        writer.write(FIXTURES[name])
+
+
+@pytest.fixture(scope='module')
+def temp_root():
+    with tempfile.TemporaryDirectory(dir=TEMP_ROOT) as directory:
+        yield directory
+
+
+@pytest.fixture
+def location(temp_root, monkeypatch):
+    directory = path.join(temp_root, uuid4().hex)
+    os.mkdir(directory)
+    monkeypatch.setattr(entities, 'default_base', f'{directory}/')
+    yield directory
+    shutil.rmtree(directory)
 
 
 @pytest.fixture
-def grammateus():
-    return Grammateus(origin='anthropic', location='test_records.jsonl')
+def grammateus(location):
+    with Grammateus(origin='anthropic',
+                    location='test_records.jsonl') as grammateus:
+        yield grammateus
+
+
+def test_init_reads_existing_files(location):
+    write_fixture(path.join(location, 'anthropic', 'test_records.jsonl'),
+                  'records_2')
+    write_fixture(path.join(location, 'AILogs', 'anthropic',
+                            'test_records.jsonl'), 'log_2')
+    with Grammateus(origin='anthropic',
+                    location='test_records.jsonl') as grammateus:
+        assert grammateus.get_records() == [{'record1': 'value1'},
+                                            {'record2': 'value2'}]
+        assert grammateus.get_log() == [{'event': 'request'},
+                                        {'event': 'response'}]
+
+
+def test_use_after_close(grammateus):
+    grammateus.record({'record1': 'value1'})
+    grammateus.log_event({'event': 'request'})
+    grammateus.close()
+    grammateus.record({'record2': 'value2'})
+    grammateus.log_event({'event': 'response'})
+    assert grammateus.get_records() == [{'record1': 'value1'},
+                                        {'record2': 'value2'}]
+    assert grammateus.get_log() == [{'event': 'request'},
+                                    {'event': 'response'}]
+
+
+def test_del_skips_fsync(location):
+    grammateus = Grammateus(origin='anthropic', location='test_records.jsonl')
+    grammateus.record({'record1': 'value1'})
+    grammateus.log_event({'event': 'request'})
+    with mock.patch.object(entities.os, 'fsync') as fsync:
+        del grammateus
+    fsync.assert_not_called()
+    with Grammateus(origin='anthropic',
+                    location='test_records.jsonl') as reopened:
+        assert reopened.get_records() == [{'record1': 'value1'}]
+
+
+def test_close_releases_files_on_error(grammateus):
+    grammateus.record({'record1': 'value1'})
+    grammateus.log_event({'event': 'request'})
+    records, log = grammateus._records, grammateus._log
+    with mock.patch.object(entities.os, 'fsync',
+                           side_effect=OSError(28, 'No space left')):
+        with pytest.raises(OSError):
+            grammateus.close()
+    assert records._file.closed
+    assert log._fd is None
+
+
+def test_log_only(grammateus):
+    grammateus.log_event({'event': 'request'})
+    assert grammateus.records == []
+    assert grammateus.get_records() == []
+    assert path.exists(grammateus.log_location)
+    assert not path.exists(path.dirname(grammateus.location))
+
+
+def test_record_only(grammateus, location):
+    grammateus.record({'record1': 'value1'})
+    assert grammateus.get_log() == []
+    assert path.exists(grammateus.location)
+    assert not path.exists(path.join(location, 'AILogs'))
+
+
+def test_append_after_unterminated_line(location):
+    write_fixture(path.join(location, 'anthropic', 'test_records.jsonl'),
+                  'records_gaps')
+    write_fixture(path.join(location, 'AILogs', 'anthropic',
+                            'test_records.jsonl'), 'records_gaps')
+    with Grammateus(origin='anthropic',
+                    location='test_records.jsonl') as grammateus:
+        grammateus.record({'record3': 'value3'})
+        grammateus.log_event({'record3': 'value3'})
+    expected = [{'record1': 'value1'},
+                {'record2': 'value2'},
+                {'record3': 'value3'}]
+    with Grammateus(origin='anthropic',
+                    location='test_records.jsonl') as reopened:
+        assert reopened.get_records() == expected
+        assert reopened.get_log() == expected
 
 
 def test_record(grammateus):
-    assert False
+    grammateus.record({'record1': 'value1'})
+    grammateus.record(dumps({'record2': 'value2'}))
+    grammateus.flush()
+    with open(grammateus.location, 'rb') as reader:
+        records = [orjson.loads(line) for line in reader]
+    assert records == [{'record1': 'value1'},
+                       {'record2': 'value2'}]
 
 
-def test_log_event(grammateus):
-    assert False
+def test_record_non_str_keys(grammateus):
+    grammateus.record({1: 'value1'})
+    grammateus.flush()
+    with open(grammateus.location, 'rb') as reader:
+        assert reader.read() == b'{"1":"value1"}\n'
+
+
+def test_record_json_string(grammateus):
+    grammateus.record('{"record1": "value1"}')
+    grammateus.record(dumps({'record2': 'value2'}, indent=2))
+    grammateus.flush()
+    with open(grammateus.location, 'rb') as reader:
+        assert reader.read() == (b'{"record1": "value1"}\n'
+                                 b'{   "record2": "value2" }\n')
+    assert grammateus.get_records() == [{'record1': 'value1'},
+                                        {'record2': 'value2'}]
+
+
+def test_record_long_int_string(grammateus):
+    grammateus.record('{"id": 1180591620717411303424}')
+    assert grammateus.get_records() == [{'id': 1180591620717411303424}]
+    grammateus.close()
+    assert grammateus.get_records() == [{'id': 1180591620717411303424}]
+
+
+def test_record_nan(grammateus):
+    grammateus.record({'score': float('nan')})
+    # NaN is written as null, the cache has to say the same
+    assert grammateus.get_records() == [{'score': None}]
+    grammateus.close()
+    assert grammateus.get_records() == [{'score': None}]
 
 
 def test_get_records(grammateus):
-    assert False
+    grammateus.record({'record1': 'value1'})
+    grammateus.record_many([{'record2': 'value2'},
+                            '{"record3": "value3"}'])
+    with pytest.raises(TypeError):
+        grammateus.record_many([{'record4': 'value4'}, 42])
+    expected = [{'record1': 'value1'},
+                {'record2': 'value2'},
+                {'record3': 'value3'}]
+    assert grammateus.get_records() == expected
+    grammateus.close()
+    reopened = Grammateus(origin='anthropic', location='test_records.jsonl')
+    assert reopened.get_records() == expected
+
+
+def test_get_records_returns_copy(grammateus):
+    grammateus.record({'record1': 'value1'})
+    records = grammateus.get_records()
+    records.append({'record2': 'value2'})
+    assert grammateus.get_records() == [{'record1': 'value1'}]
+    assert grammateus.records == [{'record1': 'value1'}]
+
+
+def test_log_event(grammateus):
+    event = {'event': 'request', 'model': 'claude-3-sonnet-20240229'}
+    grammateus.log_event(event)
+    grammateus.flush()
+    # one event is written exactly once, as a single line
+    assert path.getsize(grammateus.log_location) == len(orjson.dumps(event)) + 1
+    assert grammateus.get_log() == [event]
+
+
+def test_log_event_json_string(grammateus):
+    grammateus.log_event('{"event": "request"}')
+    assert grammateus.get_log() == [{'event': 'request'}]
+
+
+def test_log_many(grammateus):
+    events = [{'event': f'event{number}'} for number in range(5)]
+    with mock.patch.object(entities.os, 'write',
+                           wraps=entities.os.write) as write:
+        grammateus.log_many(events)
+    # the whole batch goes out in one write
+    assert write.call_count == 1
+    with open(grammateus.log_location, 'rb') as reader:
+        assert len(reader.read().splitlines()) == len(events)
+    assert grammateus.get_log() == events
+
+
+def test_log_many_mixed(grammateus):
+    grammateus.log_many([{'event': 'request'}, '{"event": "response"}'])
+    with pytest.raises(TypeError):
+        grammateus.log_many([{'event': 'dropped'}, None])
+    assert grammateus.get_log() == [{'event': 'request'},
+                                    {'event': 'response'}]
+
+
+def test_get_log_cached(grammateus, monkeypatch):
+    grammateus.log_event({'event': 'request'})
+    assert grammateus.get_log() == [{'event': 'request'}]
+    grammateus.log_event({'event': 'response'})
+    # the file only grew by our own event, so it must not be parsed again
+    monkeypatch.setattr(entities, '_read_jsonl', None)
+    assert grammateus.get_log() == [{'event': 'request'},
+                                    {'event': 'response'}]
+
+
+def test_get_log_returns_copy(grammateus):
+    grammateus.log_event({'event': 'request'})
+    log = grammateus.get_log()
+    log.clear()
+    grammateus.log_event({'event': 'response'})
+    assert log == []
+    assert grammateus.get_log() == [{'event': 'request'},
+                                    {'event': 'response'}]
+
+
+def test_get_log_raw_append(grammateus):
+    grammateus.log_event({'event': 'request'})
+    assert grammateus.get_log() == [{'event': 'request'}]
+    grammateus._append_raw(orjson.dumps({'event': 'external'}) + b'\n')
+    assert grammateus.get_log() == [{'event': 'request'},
+                                    {'event': 'external'}]
+
+
+def test_record_invalid_json(grammateus):
+    with pytest.raises(InvalidJSONRecord):
+        grammateus.record('{invalid json')
+    assert grammateus.get_records() == []
+
+
+def test_log_event_invalid_json(grammateus):
+    with pytest.raises(InvalidJSONRecord):
+        grammateus.log_event('{invalid json')
+    assert grammateus.get_log() == []
+
+
+def test_record_wrong_type(grammateus):
+    with pytest.raises(TypeError):
+        grammateus.record(['record1', 'value1'])
+    grammateus.record(OrderedDict(record1='value1'))
+    assert grammateus.get_records() == [{'record1': 'value1'}]
+
+
+def test_log_event_wrong_type(grammateus):
+    with pytest.raises(TypeError):
+        grammateus.log_event(42)
+    grammateus.log_event(OrderedDict(event='request'))
+    assert grammateus.get_log() == [{'event': 'request'}]
+
+
+def test_read_jsonl(location):
+    records_location = path.join(location, 'records.jsonl')
+    write_fixture(records_location, 'records_gaps')
+    assert entities._read_jsonl(records_location) == [{'record1': 'value1'},
+                                                      {'record2': 'value2'}]
+
+
+def test_read_jsonl_nan(location):
+    records_location = path.join(location, 'records.jsonl')
+    write_fixture(records_location, 'records_nan')
+    records = entities._read_jsonl(records_location)
+    assert records[0]['score'] != records[0]['score']  # NaN
+    assert records[1] == {'score': 1.5}
+
+
+def test_read_jsonl_long_int(location):
+    records_location = path.join(location, 'records.jsonl')
+    write_fixture(records_location, 'records_long_int')
+    assert entities._read_jsonl(records_location) == [
+        {'id': 1180591620717411303424}]
+
+
+def test_read_jsonl_empty(location):
+    records_location = path.join(location, 'records.jsonl')
+    open(records_location, 'wb').close()
+    assert entities._read_jsonl(records_location) == []